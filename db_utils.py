@@ -1,17 +1,25 @@
 import os
 import json
 import uuid
+import asyncio
+import atexit
 import time
+import hashlib
+import sqlite3
+import threading
 import numpy as np
 import traceback 
-from typing import List, Dict, Any
-from dotenv import load_dotenv
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+from env_utils import load_env
 import chromadb
 from chromadb.config import Settings
-import requests
+import httpx
+import json_utils
 
 # Load environment variables
-load_dotenv()
+load_env()
 
 # Constants
 DB_DIR = os.getenv("DB_DIR", "./chromadb")
@@ -19,85 +27,476 @@ OLLAMA_API = os.getenv("OLLAMA_URL", "http://127.0.0.1:11434")
 EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
 N_CONTEXTS = int(os.getenv("N_CONTEXTS", "3"))
 SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", "0.6"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "256"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "1024"))
+EMBED_CACHE_PATH = os.path.expanduser(os.getenv("EMBED_CACHE_PATH", "~/.cache/ollama-tools/embed.db"))  # Empty to disable
+EMBED_CACHE_ROWS = int(os.getenv("EMBED_CACHE_ROWS", "10000"))  # Least recently used embeddings beyond this are dropped from disk
+ADD_BATCH_SIZE = min(max(int(os.getenv("ADD_BATCH_SIZE", "64")), 1), 250)
+ADD_FLUSH_INTERVAL = float(os.getenv("ADD_FLUSH_INTERVAL", "1.0"))  # Seconds to wait for more conversations before writing a batch
 DEBUG_MODE = os.getenv("DEBUG_MODE", "False").lower() == "true"
 
+COLLECTION_NAME = "conversations"
+# Temporary collection used while moving a pre-cosine collection over
+MIGRATION_COLLECTION_NAME = "conversations_cosine_migration"
+MIGRATION_BATCH_SIZE = 1000
+
 # Initialize ChromaDB client with telemetry disabled
 client = chromadb.PersistentClient(path=DB_DIR, settings=Settings(anonymized_telemetry=False))
 
+# Shared HTTP client so embedding calls reuse pooled keep-alive connections to Ollama
+_http = httpx.Client(
+    timeout=httpx.Timeout(300.0, connect=10.0),
+    limits=httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30.0),
+)
+
+# Dedicated threads for blocking Chroma calls, so batched writes and context queries
+# don't compete with other to_thread work in the default executor
+_chroma_exec = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chroma")
+
 # Global variable to store the ChromaDB collection
 vector_db = None
+_collection_lock = threading.Lock()
+
+# Conversations waiting to be written by the background writer task
+_write_queue: asyncio.Queue = None
+_writer_task: asyncio.Task = None
+_unwritten: List[Dict[str, str]] = []
+
+# Recent (float16 prompt embedding, response, has tool calls) entries keyed by (conversation key, prompt hash)
+_sem_cache: "OrderedDict[Tuple[bytes, bytes], Tuple[np.ndarray, str, bool]]" = OrderedDict()
+# Stacked cache vectors and their keys, rebuilt lazily after the cache changes
+_sem_matrix = None
+_sem_keys: List[Tuple[bytes, bytes]] = []
+
+# Recent embeddings keyed by (model, text hash), plus requests still in flight
+_embed_cache: "OrderedDict[Tuple[str, bytes], np.ndarray]" = OrderedDict()
+_embed_inflight: Dict[Tuple[str, bytes], Future] = {}
+_embed_lock = threading.Lock()
+
+# Embeddings persisted across runs, opened on first use
+_embed_db: sqlite3.Connection = None
+_embed_db_rows = 0
+_embed_db_lock = threading.Lock()
 
-def debug_print(message):
-    if DEBUG_MODE:
+if DEBUG_MODE:
+    def debug_print(message):
         print(f"DEBUG: {message}")
+else:
+    def debug_print(message):
+        pass
+
+def _is_cosine(collection) -> bool:
+    # Chroma keeps the distance space a collection was created with; older ones default to squared L2
+    return (collection.metadata or {}).get("hnsw:space") == "cosine"
+
+def _finish_interrupted_migration():
+    """
+    Clean up after a migration that stopped part way: keep the copy if the original was
+    already deleted, otherwise drop the partial copy so the migration starts over.
+    """
+    try:
+        copy = client.get_collection(MIGRATION_COLLECTION_NAME)
+    except Exception:
+        return
+    try:
+        client.get_collection(COLLECTION_NAME)
+    except Exception:
+        copy.modify(name=COLLECTION_NAME)
+        return
+    client.delete_collection(MIGRATION_COLLECTION_NAME)
+
+def _migrate_to_cosine(collection):
+    """
+    Move a collection created before the switch to cosine space into a new cosine collection.
+    Older rows hold raw, un-normalized embeddings, so every stored vector is normalized on the way.
+    """
+    debug_print(f"Migrating collection '{COLLECTION_NAME}' ({collection.count()} rows) to cosine space")
+    target = client.create_collection(name=MIGRATION_COLLECTION_NAME, metadata={"hnsw:space": "cosine"})
+    offset = 0
+    while True:
+        rows = collection.get(limit=MIGRATION_BATCH_SIZE, offset=offset, include=['embeddings', 'documents', 'metadatas'])
+        if not rows['ids']:
+            break
+        target.add(
+            ids=rows['ids'],
+            embeddings=normalize(rows['embeddings']).tolist(),
+            documents=rows['documents'],
+            metadatas=rows['metadatas']
+        )
+        offset += len(rows['ids'])
+    client.delete_collection(COLLECTION_NAME)
+    target.modify(name=COLLECTION_NAME)
+    return target
 
 def ensure_collection_exists():
     global vector_db
+    if vector_db is not None:
+        return
+    with _collection_lock:
+        if vector_db is not None:
+            return
+        try:
+            _finish_interrupted_migration()
+            collection = client.get_or_create_collection(name=COLLECTION_NAME, metadata={"hnsw:space": "cosine"})
+            if not _is_cosine(collection):
+                try:
+                    collection = _migrate_to_cosine(collection)
+                except Exception as e:
+                    # Keep using the old collection; retrieve_context skips it until a later run migrates it
+                    debug_print(f"Error migrating collection to cosine space: {str(e)}")
+            vector_db = collection
+            debug_print(f"Using existing or created new collection '{COLLECTION_NAME}'. Count: {vector_db.count()}")
+        except Exception as e:
+            debug_print(f"Error in ensure_collection_exists: {str(e)}")
+
+def _get_collection():
+    """
+    Return the conversations collection, creating it only if import-time setup failed.
+    """
+    ensure_collection_exists()
+    return vector_db
+
+def normalize(vectors) -> np.ndarray:
+    """
+    Return float32 copies of the vectors scaled to unit length along the last axis.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / (np.linalg.norm(vectors, axis=-1, keepdims=True) + 1e-12)
+
+def _prompt_key(prompt: str) -> bytes:
+    # Collapse whitespace so trivially different copies of a prompt share cache entries
+    normalized = " ".join(prompt.split())
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest()
+
+def _open_embed_db():
+    global _embed_db, _embed_db_rows, EMBED_CACHE_PATH
+    if _embed_db is None and EMBED_CACHE_PATH:
+        try:
+            os.makedirs(os.path.dirname(EMBED_CACHE_PATH) or ".", exist_ok=True)
+            db = sqlite3.connect(EMBED_CACHE_PATH, check_same_thread=False)
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS embeddings(k TEXT PRIMARY KEY, v BLOB, t REAL NOT NULL)")
+                db.execute("CREATE INDEX IF NOT EXISTS embeddings_t ON embeddings(t)")
+            _embed_db_rows = db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            _embed_db = db
+        except (sqlite3.Error, OSError) as e:
+            debug_print(f"Embedding cache disabled, could not open {EMBED_CACHE_PATH}: {str(e)}")
+            EMBED_CACHE_PATH = ""
+    return _embed_db
+
+def _embed_db_key(key: Tuple[str, bytes]) -> str:
+    model, digest = key
+    return f"{model}:{digest.hex()}"
+
+def _load_stored_embeddings(keys: List[Tuple[str, bytes]]) -> Dict[Tuple[str, bytes], np.ndarray]:
+    """
+    Return the embeddings saved by earlier runs for whichever of the keys have one,
+    marking them as recently used.
+    """
+    by_db_key = {_embed_db_key(key): key for key in keys}
+    with _embed_db_lock:
+        db = _open_embed_db()
+        if db is None or not by_db_key:
+            return {}
+        try:
+            rows = db.execute(
+                f"SELECT k, v FROM embeddings WHERE k IN ({','.join('?' * len(by_db_key))})", list(by_db_key)
+            ).fetchall()
+            if rows:
+                with db:
+                    db.execute(
+                        f"UPDATE embeddings SET t = ? WHERE k IN ({','.join('?' * len(rows))})",
+                        [time.time()] + [k for k, _ in rows],
+                    )
+        except sqlite3.Error as e:
+            debug_print(f"Error reading embedding cache: {str(e)}")
+            return {}
+    return {by_db_key[k]: np.frombuffer(v, dtype=np.float32) for k, v in rows}
+
+def _save_embeddings(embeddings: Dict[Tuple[str, bytes], np.ndarray]):
+    """
+    Save new embeddings, then drop the least recently used ones beyond EMBED_CACHE_ROWS.
+    """
+    global _embed_db_rows
+    with _embed_db_lock:
+        db = _open_embed_db()
+        if db is None or not embeddings:
+            return
+        now = time.time()
+        try:
+            with db:
+                inserted = db.executemany(
+                    "INSERT OR IGNORE INTO embeddings(k, v, t) VALUES (?, ?, ?)",
+                    [(_embed_db_key(key), embedding.tobytes(), now) for key, embedding in embeddings.items()],
+                ).rowcount
+                excess = _embed_db_rows + inserted - EMBED_CACHE_ROWS
+                if excess > 0:
+                    db.execute("DELETE FROM embeddings WHERE k IN (SELECT k FROM embeddings ORDER BY t LIMIT ?)", (excess,))
+            _embed_db_rows = min(_embed_db_rows + inserted, EMBED_CACHE_ROWS)
+        except sqlite3.Error as e:
+            debug_print(f"Error writing embedding cache: {str(e)}")
+
+def conversation_key(messages) -> bytes:
+    """
+    Hash the conversation so far, so cached responses are only reused in the same conversation state.
+    An empty conversation gives an empty key.
+    """
+    if not messages:
+        return b""
+    digest = hashlib.blake2b(digest_size=16)
+    for message in messages:
+        digest.update(message["role"].encode('utf-8') + b"\0")
+        digest.update(message["content"].encode('utf-8') + b"\0")
+    return digest.digest()
+
+# Flipped once /api/embeddings works where /api/embed 404s, so older Ollama servers keep working
+use_legacy_embed_api = False
+
+def _is_missing_model(response: httpx.Response) -> bool:
+    # Servers that have /api/embed also answer 404 for a model that hasn't been pulled
     try:
-        vector_db = client.get_or_create_collection(name='conversations')
-        debug_print(f"Using existing or created new collection 'conversations'. Count: {vector_db.count()}")
-    except Exception as e:
-        debug_print(f"Error in ensure_collection_exists: {str(e)}")
+        error = response.json().get("error", "")
+    except (ValueError, AttributeError):
+        return False
+    return "model" in error and "not found" in error
 
-def get_embedding(prompt: str) -> List[float]:
+def _post_embed(inputs: List[str]) -> List[List[float]]:
+    response = _http.post(f"{OLLAMA_API}/api/embed", json={"model": EMBED_MODEL, "input": inputs})
+    response.raise_for_status()
+    return response.json()["embeddings"]
+
+def _post_legacy_embedding(prompt: str) -> List[float]:
+    response = _http.post(f"{OLLAMA_API}/api/embeddings", json={"model": EMBED_MODEL, "prompt": prompt})
+    response.raise_for_status()
+    return response.json().get('embedding')
+
+def _fetch_embeddings(prompts: List[str]) -> List[List[float]]:
+    global use_legacy_embed_api
     try:
-        debug_print(f"Getting embedding for prompt: {prompt[:50]}...")  # Print first 50 chars of prompt
-        response = requests.post(f"{OLLAMA_API}/api/embeddings", json={"model": EMBED_MODEL, "prompt": prompt})
-        response.raise_for_status()
-        embedding = response.json().get('embedding')
-        if embedding is None:
-            debug_print("Embedding is None in API response")
-        else:
-            debug_print(f"Successfully got embedding of length {len(embedding)}")
-        return embedding
-    except requests.RequestException as e:
-        debug_print(f"Error getting embedding: {str(e)}")
+        debug_print(f"Getting embeddings for {len(prompts)} prompt(s)")
+        if not use_legacy_embed_api:
+            try:
+                embeddings = _post_embed(prompts)
+                debug_print(f"Successfully got {len(embeddings)} embedding(s)")
+                return embeddings
+            except (httpx.HTTPStatusError, KeyError) as e:
+                if isinstance(e, httpx.HTTPStatusError) and (
+                        e.response.status_code != 404 or _is_missing_model(e.response)):
+                    raise
+                debug_print("/api/embed not available, trying /api/embeddings")
+                embeddings = [_post_legacy_embedding(prompt) for prompt in prompts]
+                use_legacy_embed_api = True
+                return embeddings
+        return [_post_legacy_embedding(prompt) for prompt in prompts]
+    except httpx.HTTPError as e:
+        debug_print(f"Error getting embeddings: {str(e)}")
         return None
 
-def add_to_vector_db(conversation: Dict[str, str]):
-    global vector_db
-    ensure_collection_exists()
+def get_embeddings_batch(prompts: List[str], persist: bool = True) -> np.ndarray:
+    """
+    Embed several prompts with a single request to /api/embed and return them as unit-length float32 rows.
+    Prompts embedded recently, saved by an earlier run, or currently being embedded by another caller,
+    are not sent again. Pass persist=False for one-off texts that aren't worth saving to disk.
+    """
+    embeddings = [None] * len(prompts)
+    pending = {}  # key -> (future, indexes) for the texts this call fetches
+    waiting = []  # (index, future) for texts another caller is already fetching
+    with _embed_lock:
+        for idx, prompt in enumerate(prompts):
+            key = (EMBED_MODEL, _prompt_key(prompt))
+            if key in _embed_cache:
+                _embed_cache.move_to_end(key)
+                embeddings[idx] = _embed_cache[key]
+            elif key in pending:
+                pending[key][1].append(idx)
+            elif key in _embed_inflight:
+                waiting.append((idx, _embed_inflight[key]))
+            else:
+                future = Future()
+                _embed_inflight[key] = future
+                pending[key] = (future, [idx])
+    
+    if pending:
+        found = {}
+        try:
+            found = _load_stored_embeddings(list(pending)) if persist else {}
+            missing = [key for key in pending if key not in found]
+            if missing:
+                fetched = _fetch_embeddings([prompts[pending[key][1][0]] for key in missing])
+                if fetched:
+                    new = {key: normalize(embedding) for key, embedding in zip(missing, fetched) if embedding is not None}
+                    if persist:
+                        _save_embeddings(new)
+                    found.update(new)
+        finally:
+            with _embed_lock:
+                for key, (future, indexes) in pending.items():
+                    embedding = found.get(key)
+                    if embedding is not None:
+                        embedding.flags.writeable = False  # Shared through the cache
+                        _embed_cache[key] = embedding
+                        for idx in indexes:
+                            embeddings[idx] = embedding
+                    del _embed_inflight[key]
+                    future.set_result(embedding)
+                while len(_embed_cache) > EMBED_CACHE_SIZE:
+                    _embed_cache.popitem(last=False)
+    
+    for idx, future in waiting:
+        embeddings[idx] = future.result()
+    
+    if any(embedding is None for embedding in embeddings):
+        return None
+    if not embeddings:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.stack(embeddings)
+
+def get_embedding(prompt: str) -> np.ndarray:
+    debug_print(f"Getting embedding for prompt: {prompt[:50]}...")  # Print first 50 chars of prompt
+    embeddings = get_embeddings_batch([prompt])
+    embedding = embeddings[0] if embeddings is not None else None
+    if embedding is None:
+        debug_print("Embedding is None in API response")
+    else:
+        debug_print(f"Successfully got embedding of length {len(embedding)}")
+    return embedding
+
+async def get_embedding_async(prompt: str) -> np.ndarray:
+    return await asyncio.to_thread(get_embedding, prompt)
+
+def add_to_vector_db(conversation: Dict[str, str], embedding: np.ndarray = None):
+    add_many_to_vector_db([conversation], None if embedding is None else embedding[np.newaxis])
+
+def add_many_to_vector_db(conversations: List[Dict[str, str]], embeddings: np.ndarray = None):
+    """
+    Insert several conversations with one Chroma add.
+    Without precomputed embeddings, "prompt response" texts are embedded with one batched request.
+    """
+    collection = _get_collection()
     
     try:
-        debug_print("Adding new conversation to vector DB")
-        embedding = get_embedding(conversation['prompt'] + " " + conversation['response'])
-        if embedding is None:
-            debug_print("Failed to get embedding, skipping vector DB update")
+        debug_print(f"Adding {len(conversations)} new conversation(s) to vector DB")
+        if embeddings is None:
+            # These texts are unique to each turn and never looked up again, so keep them off disk
+            embeddings = get_embeddings_batch([c['prompt'] + " " + c['response'] for c in conversations], persist=False)
+        if embeddings is None:
+            debug_print("Failed to get embeddings, skipping vector DB update")
             return
         
-        conversation_id = str(uuid.uuid4())
-        conversation['id'] = conversation_id  # Add ID to the conversation dict
-        metadata = {"id": conversation_id, "timestamp": time.time()}
+        ids, metadatas = [], []
+        for conversation in conversations:
+            conversation_id = str(uuid.uuid4())
+            conversation['id'] = conversation_id  # Add ID to the conversation dict
+            ids.append(conversation_id)
+            # The prompt is stored as the document and the response alongside it in metadata
+            metadatas.append({"id": conversation_id, "timestamp": time.time(), "response": conversation['response']})
         
-        vector_db.add(
-            ids=[conversation_id],
-            embeddings=[embedding],
-            documents=[json.dumps(conversation)],
-            metadatas=[metadata]
+        collection.add(
+            ids=ids,
+            embeddings=embeddings.tolist(),
+            documents=[conversation['prompt'] for conversation in conversations],
+            metadatas=metadatas
         )
-        debug_print(f"Successfully added to vector DB with ID: {conversation_id}")
+        debug_print(f"Successfully added to vector DB with IDs: {ids}")
     except Exception as e:
         debug_print(f"Error in add_to_vector_db: {str(e)}")
 
-def cosine_similarity(a, b):
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+def start_writer():
+    """
+    Start the background task that persists queued conversations. Must be called from a running event loop.
+    """
+    global _write_queue, _writer_task
+    if _writer_task is None:
+        _write_queue = asyncio.Queue()
+        _writer_task = asyncio.create_task(_writer_loop())
 
-def retrieve_context(prompt: str) -> List[Dict[str, Any]]:
-    global vector_db
-    ensure_collection_exists()
+async def queue_conversation(conversation: Dict[str, str]):
+    start_writer()
+    await _write_queue.put(conversation)
+
+async def _writer_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _write_queue.get()]
+        deadline = loop.time() + ADD_FLUSH_INTERVAL
+        try:
+            while len(batch) < ADD_BATCH_SIZE:
+                try:
+                    batch.append(await asyncio.wait_for(_write_queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # Leave conversations already taken off the queue for flush_pending_writes
+            _unwritten.extend(batch)
+            raise
+        try:
+            await loop.run_in_executor(_chroma_exec, add_many_to_vector_db, batch)
+        finally:
+            for _ in batch:
+                _write_queue.task_done()
+
+async def drain_writer():
+    """
+    Wait for every queued conversation to be written, then stop the writer task.
+    """
+    global _writer_task
+    if _writer_task is None:
+        return
+    await _write_queue.join()
+    _writer_task.cancel()
+    _writer_task = None
+
+def flush_pending_writes():
+    """
+    Synchronously write any conversations still queued, for exits that skip drain_writer.
+    """
+    batch = _unwritten[:]
+    _unwritten.clear()
+    while _write_queue is not None and not _write_queue.empty():
+        batch.append(_write_queue.get_nowait())
+    if batch:
+        add_many_to_vector_db(batch)
+
+atexit.register(flush_pending_writes)
+
+def distances_to_similarities(distances: List[float]) -> List[float]:
+    """
+    Convert cosine-space query distances into cosine similarities.
+    """
+    return [1.0 - distance for distance in distances]
+
+async def retrieve_context_async(prompt: str, prompt_embedding: np.ndarray = None) -> List[Dict[str, Any]]:
+    """
+    Run the blocking embedding call and Chroma query on the Chroma worker threads.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_chroma_exec, retrieve_context, prompt, prompt_embedding)
+
+def retrieve_context(prompt: str, prompt_embedding: np.ndarray = None) -> List[Dict[str, Any]]:
+    """
+    Return the stored conversations most similar to the prompt.
+    Pass prompt_embedding when the caller already has it to skip the embedding request.
+    """
+    collection = _get_collection()
+    if collection is None or not _is_cosine(collection):
+        # A collection that couldn't be migrated has no meaningful similarity scores
+        debug_print("Vector DB is not in cosine space, returning empty context")
+        return []
     
     try:
-        debug_print(f"Retrieving context for prompt: {prompt[:80]}...")  # Print first 50 chars of prompt
-        prompt_embedding = get_embedding(prompt)
         if prompt_embedding is None:
-            debug_print("Failed to get embedding for prompt, returning empty context")
-            return []
+            debug_print(f"Retrieving context for prompt: {prompt[:80]}...")  # Print first 50 chars of prompt
+            prompt_embedding = get_embedding(prompt)
+            if prompt_embedding is None:
+                debug_print("Failed to get embedding for prompt, returning empty context")
+                return []
         
         debug_print(f"Querying vector DB with embedding of length {len(prompt_embedding)}")
-        results = vector_db.query(
-            query_embeddings=[prompt_embedding],
+        results = collection.query(
+            query_embeddings=[prompt_embedding.tolist()],
             n_results=N_CONTEXTS,
-            include=['documents', 'embeddings', 'metadatas']
+            include=['documents', 'metadatas', 'distances']
         )
         
         # debug_print(f"Raw query results: {json.dumps(results, indent=2)}")
@@ -105,40 +504,83 @@ def retrieve_context(prompt: str) -> List[Dict[str, Any]]:
         contexts = []
         if isinstance(results, dict) and 'documents' in results and results['documents']:
             documents = results['documents'][0]
-            embeddings = results['embeddings'][0]
             metadatas = results.get('metadatas', [[]])[0]
+            similarities = distances_to_similarities(results['distances'][0])
             
-            for doc, embedding, metadata in zip(documents, embeddings, metadatas):
-                try:
-                    context = json.loads(doc)
-                    similarity = cosine_similarity(prompt_embedding, embedding)
-                    
-                    # Handle cases where metadata might be None
-                    if metadata is not None:
-                        context['id'] = metadata.get('id') or context.get('id', 'Unknown')
-                    else:
-                        context['id'] = context.get('id', 'Unknown')
-                    
-                    context['similarity'] = similarity
-                    contexts.append(context)
-                except json.JSONDecodeError:
-                    debug_print(f"Error decoding document: {doc}")
+            for doc, similarity, metadata in zip(documents, similarities, metadatas):
+                # Handle cases where metadata might be None
+                metadata = metadata or {}
+                if 'response' in metadata:
+                    context = {"prompt": doc, "response": metadata['response'], "id": metadata.get('id', 'Unknown')}
+                else:
+                    # Older records store the whole conversation as a JSON document
+                    try:
+                        context = json_utils.loads(doc)
+                    except json.JSONDecodeError:
+                        debug_print(f"Error decoding document: {doc}")
+                        continue
+                    context['id'] = metadata.get('id') or context.get('id', 'Unknown')
+                
+                context['similarity'] = similarity
+                contexts.append(context)
             
             # Sort contexts by similarity (highest first) and take top N_CONTEXTS
             contexts.sort(key=lambda x: x['similarity'], reverse=True)
             contexts = contexts[:N_CONTEXTS]
         
-        debug_print(f"Retrieved {len(contexts)} contexts")
-        for idx, context in enumerate(contexts, 1):
-            debug_print(f"Context {idx} (similarity: {context['similarity']:.4f}):")
-            debug_print(f"  ID: {context['id']}")
-            debug_print(f"  Prompt: {context['prompt']}")
-            debug_print(f"  Response: {context['response'][:50]}...")  # Truncate long responses
+        if DEBUG_MODE:
+            debug_print(f"Retrieved {len(contexts)} contexts")
+            for idx, context in enumerate(contexts, 1):
+                debug_print(f"Context {idx} (similarity: {context['similarity']:.4f}):")
+                debug_print(f"  ID: {context['id']}")
+                debug_print(f"  Prompt: {context['prompt']}")
+                debug_print(f"  Response: {context['response'][:50]}...")  # Truncate long responses
         return contexts
     except Exception as e:
         debug_print(f"Error in retrieve_context: {str(e)}")
         debug_print(f"Exception details: {traceback.format_exc()}")
         return []
 
+def semantic_lookup(prompt: str, prompt_embedding: np.ndarray, history_key: bytes = b"",
+                    threshold: float = SEMANTIC_CACHE_THRESHOLD) -> Optional[str]:
+    """
+    Return a cached response for this prompt, or one semantically close to it, given in the same
+    conversation state (see conversation_key). Near matches never return responses with tool calls,
+    since a small difference in the prompt can mean different tool arguments.
+    """
+    global _sem_matrix, _sem_keys
+    key = (history_key, _prompt_key(prompt))
+    if key not in _sem_cache:
+        if prompt_embedding is None or not _sem_cache:
+            return None
+        if _sem_matrix is None:
+            _sem_keys = list(_sem_cache)
+            _sem_matrix = np.stack([vector for vector, _, _ in _sem_cache.values()])
+        allowed = np.fromiter(
+            (cached_key[0] == history_key and not _sem_cache[cached_key][2] for cached_key in _sem_keys),
+            dtype=bool, count=len(_sem_keys)
+        )
+        if not allowed.any():
+            return None
+        # Stored as float16 to keep the cache small; upcast for the product
+        similarities = np.where(allowed, _sem_matrix.astype(np.float32) @ prompt_embedding, -np.inf)
+        best = int(np.argmax(similarities))
+        if similarities[best] < threshold:
+            return None
+        debug_print(f"Semantic cache hit (similarity: {similarities[best]:.4f})")
+        key = _sem_keys[best]
+    _sem_cache.move_to_end(key)
+    return _sem_cache[key][1]
+
+def semantic_store(prompt: str, prompt_embedding: np.ndarray, response: str, history_key: bytes = b""):
+    global _sem_matrix
+    if prompt_embedding is None:
+        return
+    has_tool_calls = "<tool_call>" in response
+    _sem_cache[(history_key, _prompt_key(prompt))] = (prompt_embedding.astype(np.float16), response, has_tool_calls)
+    while len(_sem_cache) > SEMANTIC_CACHE_SIZE:
+        _sem_cache.popitem(last=False)
+    _sem_matrix = None
+
 # Initialize the collection when the module is imported
 ensure_collection_exists()
\ No newline at end of file
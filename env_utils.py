@@ -0,0 +1,12 @@
+# env_utils.py
+from functools import lru_cache
+from dotenv import load_dotenv
+
+
+@lru_cache(maxsize=1)
+def load_env() -> bool:
+    """
+    Load variables from .env into the environment. Every module calls this at import,
+    but only the first call searches for and parses the file.
+    """
+    return load_dotenv()
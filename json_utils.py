@@ -0,0 +1,31 @@
+# json_utils.py
+import json
+from typing import Any
+
+# orjson is much faster on the per-turn hot paths; fall back to the standard library without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj: Any, pretty: bool = False) -> str:
+    """
+    Serialize an object to a JSON string, pretty-printed with two-space indents if requested.
+    Output is orjson's format with either backend: compact separators and non-ASCII left
+    unescaped, unlike json.dumps defaults.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0).decode("utf-8")
+    if pretty:
+        return json.dumps(obj, indent=2, ensure_ascii=False)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+def loads(data: Any) -> Any:
+    """
+    Parse a JSON str or bytes. Invalid input raises json.JSONDecodeError with either backend.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -1,15 +1,16 @@
 import os
 import io
-import json
+import re
+import time
 import asyncio
 import signal
 import traceback
 import logging
-from typing import List, Dict, Any, AsyncIterator
+from typing import Dict, AsyncIterator, Optional
+from collections import deque
 from contextlib import redirect_stdout
-from urllib.parse import urlparse
-from textwrap import wrap
-from dotenv import load_dotenv
+from textwrap import TextWrapper
+from env_utils import load_env
 from langchain_ollama import ChatOllama
 from langchain_core.messages import AIMessage
 from rich.console import Console
@@ -19,16 +20,17 @@ from rich.markdown import Markdown
 from rich.live import Live
 from rich.table import Table
 from rich.text import Text
+from rich.style import Style
 from rich import box
-from rich.markup import escape
-from tools import AVAILABLE_TOOLS, execute_tool
-from search_utils import SEARCH_PROVIDER
-from db_utils import retrieve_context, add_to_vector_db, EMBED_MODEL
+import json_utils
+from tools import TOOLS_JSON_STRING, execute_tool, init_logging
+from search_utils import SEARCH_PROVIDER, close_search_clients, url_domain
+from db_utils import get_embedding_async, retrieve_context_async, queue_conversation, drain_writer, semantic_lookup, semantic_store, conversation_key, EMBED_MODEL
 
 # Load environment variables
-load_dotenv()
+load_env()
 
-conversation_history = []
+conversation_history: deque = deque(maxlen=10)  # Last five user/assistant turns
 should_exit = False
 
 # Setup rich console for beautiful terminal output
@@ -38,6 +40,10 @@ console = Console()
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3-groq-tool-use")
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://127.0.0.1:11434")
 DEBUG_MODE = os.getenv("DEBUG_MODE", "False").lower() == "true"
+STREAM_UPDATE_INTERVAL = 0.1  # Seconds between live display updates while streaming
+STREAM_TAIL_CHARS = 2048  # Only the end of a long response is shown while it streams
+CONTEXT_RESPONSE_CHARS = 512  # Stored responses are cut to this length in the system message to keep prefill short
+HISTORY_MESSAGE_CHARS = 2048  # Messages kept in conversation_history are cut to this length
 
 # Disable unwanted logging
 logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -50,6 +56,31 @@ def signal_handler(sig, frame):
 
 signal.signal(signal.SIGINT, signal_handler)
 
+# A tool call, plus any <tool_response> the model wrote for it itself (replaced by the real one)
+TOOL_CALL_END = "</tool_call>"
+TOOL_CALL_RE = re.compile(r"<tool_call>(.*?)</tool_call>(?:\s*<tool_response>.*?</tool_response>)?", re.DOTALL)
+
+# The system message never changes, so Ollama can reuse its cached prefill across turns
+SYSTEM_MESSAGE = f"""You are a helpful AI assistant with access to previous conversation contexts and various tools. 
+Your responses should be informative, engaging, and tailored to the user's needs. 
+Carefully review the information from the provided contexts in your responses.
+The contexts are sorted by relevance, with the most relevant context listed first but take into account all previous context.
+Always prefer information from these contexts over making assumptions or using general knowledge. DO NOT use a tool unless the user asks you to do so.
+
+You may call one or more functions to assist with the user query. Don't make assumptions about what values to plug into functions. 
+For each function call return a json object with function name and arguments within <tool_call></tool_call> XML tags as follows:
+<tool_call>
+{{"name": <function-name>,"arguments": <args-dict>}}
+</tool_call>
+
+Here are the available tools:
+{TOOLS_JSON_STRING}
+"""
+
+# Retrieved contexts go in their own message just before the user's prompt
+CONTEXT_MESSAGE_HEAD = "Here are the relevant contexts from previous conversations:\n"
+CONTEXT_MESSAGE_TAIL = "\n\nYou MUST use this context information to inform your responses from previous interactions."
+
 def create_llm():
     return ChatOllama(
         model=OLLAMA_MODEL,
@@ -57,9 +88,13 @@ def create_llm():
         temperature=0,
     )
 
-def print_debug(message):
-    if DEBUG_MODE:
+# DEBUG_MODE is fixed at startup, so pick the debug printer once instead of checking it per call
+if DEBUG_MODE:
+    def print_debug(message):
         console.print(f"[dim cyan]DEBUG: {message}[/dim cyan]")
+else:
+    def print_debug(message):
+        pass
 
 def print_info(message):
     console.print(f"[bold blue]INFO: {message}[/bold blue]")
@@ -67,58 +102,60 @@ def print_info(message):
 def print_warning(message):
     console.print(f"[bold yellow]WARNING: {message}[/bold yellow]")
 
-async def ollama_chat(llm: ChatOllama, prompt: str, tools: List[Dict[str, Any]]) -> AsyncIterator[str]:
-    global conversation_history
+def remember_turn(prompt: str, response: str):
+    # Tool call markup and very long messages would be re-sent on every later turn, so keep them out
+    response = TOOL_CALL_RE.sub("", response).strip()
+    conversation_history.append({"role": "user", "content": prompt[:HISTORY_MESSAGE_CHARS]})
+    conversation_history.append({"role": "assistant", "content": response[:HISTORY_MESSAGE_CHARS]})
+
+async def ollama_chat(llm: ChatOllama, prompt: str) -> AsyncIterator[str]:
+    # Embed the prompt once and reuse it for the response cache and context retrieval
+    try:
+        prompt_embedding = await get_embedding_async(prompt)
+    except Exception as e:
+        # Without an embedding the turn still goes to the model, just without retrieved context
+        print_warning(f"Could not embed the prompt, continuing without context: {str(e)}")
+        if DEBUG_MODE:
+            print_debug(f"Exception details: {traceback.format_exc()}")
+        prompt_embedding = None
     
-    # Retrieve context from the database
-    contexts = retrieve_context(prompt)
+    # Cached responses are only reused for the same conversation so far, so follow-ups like "yes" stay in context
+    history_key = conversation_key(conversation_history)
+    cached_response = semantic_lookup(prompt, prompt_embedding, history_key)
+    if cached_response is not None:
+        print_info("Using cached response from a similar prompt")
+        remember_turn(prompt, cached_response)
+        yield cached_response
+        return
+    
+    contexts = await retrieve_context_async(prompt, prompt_embedding) if prompt_embedding is not None else []
     
     if contexts:
         print_info("Retrieved relevant contexts:")
-        for idx, context in enumerate(contexts, 1):
-            console.print(f"  Context {idx} (similarity: {context['similarity']:.4f}):")
-            console.print(f"    Prompt: {context['prompt']}")
-            console.print(f"    Response: {context['response'][:90]}...")  # Truncate long responses
     else:
         print_info("No relevant contexts found.")
     
-    # Format tools for the model
-    tools_string = "<tools>\n" + "\n".join([json.dumps(tool["function"]) for tool in tools]) + "\n</tools>"
-    
-    # Prepare context information
-    context_info = "\n".join([
-        f"Context {idx + 1} (similarity: {context['similarity']:.4f}):\n"
-        f"Prompt: {context['prompt']}\n"
-        f"Response: {context['response']}\n"
-        for idx, context in enumerate(contexts)
-    ])
-
-    system_message = f"""You are a helpful AI assistant with access to previous conversation contexts and various tools. 
-Your responses should be informative, engaging, and tailored to the user's needs. 
-Carefully review the information from the provided contexts in your responses.
-The contexts are sorted by relevance, with the most relevant context listed first but take into account all previous context.
-Always prefer information from these contexts over making assumptions or using general knowledge. DO NOT use a tool unless the user asks you to do so.
-
-Here are the relevant contexts from previous conversations:
-{context_info}
-
-You MUST use this context information to inform your responses from previous interactions.
-
-You may call one or more functions to assist with the user query. Don't make assumptions about what values to plug into functions. 
-For each function call return a json object with function name and arguments within <tool_call></tool_call> XML tags as follows:
-<tool_call>
-{{"name": <function-name>,"arguments": <args-dict>}}
-</tool_call>
-
-Here are the available tools:
-{tools_string}
-"""
+    # Show the contexts and prepare the context information for the model in one pass
+    context_blocks = []
+    for idx, context in enumerate(contexts, 1):
+        similarity = format(context['similarity'], '.4f')
+        console.print(f"  Context {idx} (similarity: {similarity}):")
+        console.print(f"    Prompt: {context['prompt']}")
+        console.print(f"    Response: {context['response'][:90]}...")  # Truncate long responses
+        context_blocks.append(
+            f"Context {idx} (similarity: {similarity}):\n"
+            f"Prompt: {context['prompt']}\n"
+            f"Response: {context['response'][:CONTEXT_RESPONSE_CHARS]}\n"
+        )
+    context_info = "\n".join(context_blocks)
 
     messages = [
-        {"role": "system", "content": system_message},
+        {"role": "system", "content": SYSTEM_MESSAGE},
         *conversation_history,
-        {"role": "user", "content": prompt}
     ]
+    if context_info:
+        messages.append({"role": "system", "content": CONTEXT_MESSAGE_HEAD + context_info + CONTEXT_MESSAGE_TAIL})
+    messages.append({"role": "user", "content": prompt})
     
     print_info("Sending request to Ollama")
     try:
@@ -130,18 +167,14 @@ Here are the available tools:
                 full_response += content
                 yield content
         
-        # Add the new interaction to the vector database
-        # print_info("Adding new interaction to vector DB")
-        add_to_vector_db({
+        # Queue the new interaction for the background vector DB writer
+        await queue_conversation({
             "prompt": prompt,
             "response": full_response
         })
         
-        conversation_history.append({"role": "user", "content": prompt})
-        conversation_history.append({"role": "assistant", "content": full_response})
-        
-        if len(conversation_history) > 10:
-            conversation_history = conversation_history[-10:]
+        semantic_store(prompt, prompt_embedding, full_response, history_key)
+        remember_turn(prompt, full_response)
         
     except Exception as e:
         print_warning(f"Error in ollama_chat: {str(e)}")
@@ -150,70 +183,89 @@ Here are the available tools:
         yield "I'm sorry, I encountered an error and couldn't process your request."
 
 
-async def process_tool_calls(content: str) -> str:
-    while "<tool_call>" in content:
-        tool_call_start = content.index("<tool_call>")
-        tool_call_end = content.index("</tool_call>", tool_call_start)
-        tool_call = content[tool_call_start + 11:tool_call_end].strip()
+async def run_tool_call(tool_call: str) -> Optional[str]:
+    """
+    Execute one <tool_call> payload and return the text for its <tool_response>, or None if it is malformed.
+    """
+    try:
+        tool_data = json_utils.loads(tool_call)
+        tool_name = tool_data["name"]
+        arguments = tool_data["arguments"]
         
-        try:
-            tool_data = json.loads(tool_call)
-            tool_name = tool_data["name"]
-            arguments = tool_data["arguments"]
-            
-            print_info(f"Using tool: {tool_name}")
-            
-            if tool_name == "search":
-                print_info(f"Search provider: {SEARCH_PROVIDER}")
-            
-            result = await execute_tool(tool_name, **arguments)
-
-            if result["success"]:
-                print_info(f"Tool executed successfully.")
-                if tool_name == "list_files":
-                    files_list = "\n".join(result["files"])
-                    tool_response = f"Here are the files and directories in the specified path:\n\n{files_list}"
-                elif tool_name == "search":
-                    if result["results"]:
-                        # Capture the output of format_search_results using Rich's Console
-                        capture_console = Console(record=True, width=120)  # Adjust width as needed
-                        
-                        # Capture the table
-                        with capture_console.capture() as capture:
-                            format_search_results(result["results"])
-                        table_output = capture_console.export_text(clear=False)
-                        
-                        # Capture the URL links
-                        url_links = "Full URLs:\n"
-                        for i, result_item in enumerate(result["results"], 1):
-                            url = result_item.get("url", "N/A")
-                            url_links += f"{i}. {url}\n"
-                        
-                        # Combine the table and URL links in a code block
-                        tool_response = f"```\n{table_output}\n{url_links}\n```"
-                    else:
-                        tool_response = "No search results found."
+        print_info(f"Using tool: {tool_name}")
+        
+        if tool_name == "search":
+            print_info(f"Search provider: {SEARCH_PROVIDER}")
+        
+        result = await execute_tool(tool_name, **arguments)
+
+        if result["success"]:
+            print_info(f"Tool executed successfully.")
+            if tool_name == "list_files":
+                files_list = "\n".join(result["files"])
+                tool_response = f"Here are the files and directories in the specified path:\n\n{files_list}"
+            elif tool_name == "search":
+                if result["results"]:
+                    # Capture the output of format_search_results using Rich's Console
+                    capture_console = Console(record=True, width=120)  # Adjust width as needed
+                    
+                    # Capture the table
+                    with capture_console.capture() as capture:
+                        format_search_results(result["results"])
+                    table_output = capture_console.export_text(clear=False)
+                    
+                    # Capture the URL links
+                    url_links = "Full URLs:\n"
+                    for i, result_item in enumerate(result["results"], 1):
+                        url = result_item.get("url", "N/A")
+                        url_links += f"{i}. {url}\n"
+                    
+                    # Combine the table and URL links in a code block
+                    tool_response = f"```\n{table_output}\n{url_links}\n```"
                 else:
-                    tool_response = f"Tool result: {json.dumps(result, indent=2)}"
+                    tool_response = "No search results found."
             else:
-                print_warning(f"Error executing tool: {result.get('error', 'Unknown error')}")
-                tool_response = f"Error executing {tool_name}: {result.get('error', 'Unknown error')}"
-            
-            # Replace the tool call with the tool response
-            content = content[:tool_call_start] + f"<tool_response>\n{tool_response}\n</tool_response>" + content[tool_call_end + 12:]
+                tool_response = f"Tool result: {json_utils.dumps(result, pretty=True)}"
+        else:
+            print_warning(f"Error executing tool: {result.get('error', 'Unknown error')}")
+            tool_response = f"Error executing {tool_name}: {result.get('error', 'Unknown error')}"
         
-        except ValueError as e:
-            if "substring not found" in str(e):
-                # If <tool_response> is not found, just remove the tool call
-                content = content[:tool_call_start] + content[tool_call_end + 12:]
-            else:
-                print_warning(f"Error: {str(e)}")
-                break
-        except Exception as e:
-            print_warning(f"Error: {str(e)}")
-            break
+        return tool_response
+    except Exception as e:
+        print_warning(f"Error: {str(e)}")
+        return None
+
+def start_tool_calls(content: str, start: int, started: Dict[int, asyncio.Task]) -> int:
+    """
+    Start tasks for tool calls completed after position `start` of a partial response.
+    Tasks are keyed by the offset of their <tool_call> tag; returns the position to resume scanning from.
+    """
+    for match in TOOL_CALL_RE.finditer(content, start):
+        started[match.start()] = asyncio.create_task(run_tool_call(match.group(1).strip()))
+        start = match.end()
+    return start
+
+async def process_tool_calls(content: str, started: Dict[int, asyncio.Task] = None) -> str:
+    started = started or {}
+    matches = list(TOOL_CALL_RE.finditer(content))
+    # Run the calls not already started while streaming concurrently; gather keeps their order
+    tool_responses = await asyncio.gather(*(
+        started.get(match.start()) or run_tool_call(match.group(1).strip()) for match in matches
+    ))
     
-    return content
+    parts = []
+    last_end = 0
+    for match, tool_response in zip(matches, tool_responses):
+        parts.append(content[last_end:match.start()])
+        if tool_response is None:
+            # Leave malformed tool calls in place
+            parts.append(match.group(0))
+        else:
+            # Replace the tool call with the tool response
+            parts.append(f"<tool_response>\n{tool_response}\n</tool_response>")
+        last_end = match.end()
+    parts.append(content[last_end:])
+    return "".join(parts)
 
 async def chat_loop():
     console.print(Panel(
@@ -227,24 +279,10 @@ async def chat_loop():
     
     llm = create_llm()
     
-    tools = [
-        {
-            "type": "function",
-            "function": {
-                "name": tool["name"],
-                "description": tool["description"],
-                "parameters": {
-                    "type": "object",
-                    "properties": tool["input_schema"]["properties"],
-                    "required": tool["input_schema"].get("required", [])
-                }
-            }
-        } for tool in AVAILABLE_TOOLS
-    ]
-    
     while not should_exit:
         try:
-            user_input = Prompt.ask("\n[bold green]You")
+            # Ask in a worker thread so background tasks keep running while waiting for input
+            user_input = await asyncio.to_thread(Prompt.ask, "\n[bold green]You")
             
             if user_input.lower() in ['exit', 'quit', 'bye']:
                 break
@@ -253,14 +291,27 @@ async def chat_loop():
             
             console.print("\n[bold yellow]AI Assistant[/bold yellow]")
             with Live(Text(), refresh_per_second=4) as live:
-                response_text = Text()
-                async for chunk in ollama_chat(llm, user_input, tools):
-                    response_text.append(chunk)
-                    live.update(response_text)
+                chunks = []
+                last_update = 0.0
+                # Tool calls are started as soon as they are complete so they run while the response keeps streaming
+                tool_tasks = {}
+                scan_pos = 0
+                tail = ""  # End of the text so far, long enough to hold all but the last char of a closing tag
+                async for chunk in ollama_chat(llm, user_input):
+                    chunks.append(chunk)
+                    # Only rebuild the text when this chunk can complete a </tool_call> tag
+                    window = tail + chunk
+                    if TOOL_CALL_END in window:
+                        scan_pos = start_tool_calls("".join(chunks), scan_pos, tool_tasks)
+                    tail = window[-(len(TOOL_CALL_END) - 1):]
+                    now = time.monotonic()
+                    if now - last_update >= STREAM_UPDATE_INTERVAL:
+                        live.update(Text("".join(chunks)[-STREAM_TAIL_CHARS:]))
+                        last_update = now
                 
                 # Process tool calls after the response is complete
-                content = response_text.plain
-                processed_content = await process_tool_calls(content)
+                content = "".join(chunks)
+                processed_content = await process_tool_calls(content, tool_tasks)
                 
                 # Display the final processed response
                 live.update(Markdown(processed_content))
@@ -271,6 +322,10 @@ async def chat_loop():
             print_warning(f"An error occurred during chat: {str(e)}")
             if DEBUG_MODE:
                 print_debug(f"Exception details: {traceback.format_exc()}")
+    
+    # Make sure queued conversations reach the vector DB before exiting
+    await drain_writer()
+    await close_search_clients()
 
 
 def format_search_results(results):
@@ -281,38 +336,32 @@ def format_search_results(results):
 
     if not results:
         table.add_row("No results found", "", "")
-    else:
-        for result in results:
-            title = result.get("title", "N/A")
-            url = result.get("url", "N/A")
-            snippet = result.get("snippet", "N/A")
-            
-            # Extract domain from URL
-            domain = urlparse(url).netloc
-            
-            # Wrap the snippet text
-            wrapped_snippet = "\n".join(wrap(snippet, width=58))
-            
-            # Escape any Rich markup characters in the URL
-            escaped_url = escape(url)
-            
-            table.add_row(
-                Text(title, style="cyan"),
-                Text(f"[link={escaped_url}]{domain}[/link]", style="blue"),
-                Text(wrapped_snippet, style="green")
-            )
+
+    # Build the table rows and the full URL list in a single pass
+    wrapper = TextWrapper(width=58)
+    url_lines = []
+    for i, result in enumerate(results, 1):
+        title = result.get("title", "N/A")
+        url = result.get("url", "N/A")
+        snippet = result.get("snippet", "N/A")
+        
+        table.add_row(
+            Text(title),
+            Text(url_domain(url), style=Style(link=url)),
+            Text(wrapper.fill(snippet))
+        )
+        url_lines.append(Text.assemble(f"{i}. ", (url, Style(link=url))))
 
     console.print(table)
     
     # Print full URLs below the table
     console.print("\n[bold]Full URLs:[/bold]")
-    for i, result in enumerate(results, 1):
-        url = result.get("url", "N/A")
-        escaped_url = escape(url)
-        console.print(f"{i}. [link={escaped_url}]{escaped_url}[/link]")
+    if url_lines:
+        console.print(Text("\n").join(url_lines))
     
 
 if __name__ == "__main__":
+    init_logging(console)
     print_debug("Script started")
     try:
         asyncio.run(chat_loop())
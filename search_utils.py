@@ -1,15 +1,17 @@
 # search_utils.py
 import os
 import json
-import logging
 import asyncio
-import requests
+import logging
+import httpx
+from functools import lru_cache
 from urllib.parse import urlparse
-from dotenv import load_dotenv
-from typing import Dict, Any
+from env_utils import load_env
+import json_utils
+from typing import Dict, Any, Optional
 
 
-load_dotenv()
+load_env()
 
 logger = logging.getLogger(__name__)
 
@@ -17,11 +19,46 @@ SEARCH_PROVIDER = os.getenv("SEARCH_PROVIDER", "SEARXNG")
 SEARXNG_URL = os.getenv("SEARXNG_URL")
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 SEARCH_RESULTS_LIMIT = int(os.getenv("SEARCH_RESULTS_LIMIT", 5))
+SEARCH_RETRIES = 2  # Extra attempts when SearXNG can't be reached or answers with a 5xx
+SEARCH_RETRY_BACKOFF = 0.3  # Seconds before the first retry, doubled for each one after
 
 # Initialize Tavily client if API key is provided
 if TAVILY_API_KEY:
-    from tavily import TavilyClient
-    tavily_client = TavilyClient(api_key=TAVILY_API_KEY)
+    from tavily import AsyncTavilyClient
+    tavily_client = AsyncTavilyClient(api_key=TAVILY_API_KEY)
+
+# Shared client so SearXNG searches reuse keep-alive connections; created on first use
+_http: Optional[httpx.AsyncClient] = None
+
+def _get_http() -> httpx.AsyncClient:
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(
+            timeout=30,
+            transport=httpx.AsyncHTTPTransport(
+                retries=SEARCH_RETRIES,  # Connection failures only; 5xx responses are retried in searxng_search
+                limits=httpx.Limits(max_connections=8, max_keepalive_connections=4),
+            ),
+        )
+    return _http
+
+async def close_search_clients():
+    """
+    Close the pooled HTTP connections used by the search providers.
+    """
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+    if TAVILY_API_KEY:
+        await tavily_client.close()
+
+@lru_cache(maxsize=1024)
+def url_domain(url: str) -> str:
+    """
+    Return the domain part of a URL. Cached, since the same result URLs come back across searches.
+    """
+    return urlparse(url).netloc
 
 async def perform_search(query: str) -> Dict[str, Any]:
     """
@@ -46,11 +83,12 @@ async def searxng_search(query: str) -> Dict[str, Any]:
         "User-Agent": "OllamaAssistant/1.0"
     }
     try:
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: requests.get(SEARXNG_URL, params=params, headers=headers, timeout=30)
-        )
+        for attempt in range(SEARCH_RETRIES + 1):
+            response = await _get_http().get(SEARXNG_URL, params=params, headers=headers)
+            if response.status_code < 500 or attempt == SEARCH_RETRIES:
+                break
+            logger.debug("SearXNG returned %s, retrying", response.status_code)
+            await asyncio.sleep(SEARCH_RETRY_BACKOFF * 2 ** attempt)
         response.raise_for_status()
         results = response.json()
         
@@ -63,7 +101,8 @@ async def searxng_search(query: str) -> Dict[str, Any]:
             })
         
         return {"success": True, "results": formatted_results}
-    except requests.RequestException as e:
+    except (httpx.HTTPError, httpx.InvalidURL, ValueError, TypeError) as e:
+        # ValueError covers a non-JSON body, TypeError an unset SEARXNG_URL
         return {"success": False, "error": f"Error performing SearXNG search: {str(e)}"}
 
 
@@ -73,17 +112,13 @@ async def tavily_search(query: str) -> Dict[str, Any]:
     Perform a search using Tavily.
     """
     try:
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: tavily_client.get_search_context(query, search_depth="advanced", max_results=SEARCH_RESULTS_LIMIT)
-        )
+        response = await tavily_client.get_search_context(query, search_depth="advanced", max_results=SEARCH_RESULTS_LIMIT)
         
-        logger.debug(f"Tavily raw response: {response}")
+        logger.debug("Tavily raw response: %s", response)
         
         if isinstance(response, str):
             try:
-                results = json.loads(response)
+                results = json_utils.loads(response)
             except json.JSONDecodeError:
                 results = [response]
         elif isinstance(response, (list, dict)):
@@ -91,11 +126,12 @@ async def tavily_search(query: str) -> Dict[str, Any]:
         else:
             results = [response]
         
-        # If results are individual characters, join them
-        if all(isinstance(r, str) and len(r) == 1 for r in results):
+        # If results are individual characters, join them (check the first one before scanning them all)
+        if (results and isinstance(results[0], str) and len(results[0]) == 1
+                and all(isinstance(r, str) and len(r) == 1 for r in results)):
             joined_text = ''.join(results)
             try:
-                parsed_json = json.loads(joined_text)
+                parsed_json = json_utils.loads(joined_text)
                 if isinstance(parsed_json, list):
                     results = parsed_json
                 else:
@@ -113,10 +149,10 @@ async def tavily_search(query: str) -> Dict[str, Any]:
                 })
             elif isinstance(result, str):
                 try:
-                    result_dict = json.loads(result)
+                    result_dict = json_utils.loads(result)
                     url = result_dict.get('url', 'No URL')
                     content = result_dict.get('content', 'No content')
-                    title = result_dict.get('title', urlparse(url).netloc or "No title")
+                    title = result_dict.get('title', url_domain(url) or "No title")
                     formatted_results.append({
                         "title": title,
                         "url": url,
@@ -131,7 +167,7 @@ async def tavily_search(query: str) -> Dict[str, Any]:
             elif isinstance(result, dict):
                 url = result.get('url', 'No URL')
                 content = result.get('content', 'No content')
-                title = result.get('title', urlparse(url).netloc or "No title")
+                title = result.get('title', url_domain(url) or "No title")
                 formatted_results.append({
                     "title": title,
                     "url": url,
@@ -144,8 +180,8 @@ async def tavily_search(query: str) -> Dict[str, Any]:
                     "snippet": str(result)
                 })
         
-        logger.debug(f"Formatted results: {formatted_results}")
+        logger.debug("Formatted results: %s", formatted_results)
         return {"success": True, "results": formatted_results}
     except Exception as e:
-        logger.error(f"Error performing Tavily search: {str(e)}", exc_info=True)
+        logger.error("Error performing Tavily search: %s", e, exc_info=True)
         return {"success": False, "error": f"Error performing Tavily search: {str(e)}"}
\ No newline at end of file
@@ -1,100 +1,159 @@
 import os
+import copy
+import sys
+import mmap
+import stat
+import asyncio
 # import base64
-# import json
+import json
 import logging
-from typing import Dict, Any
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Any, List, Mapping
+import aiofiles
+import aiofiles.os
 # from datetime import datetime
 from rich.console import Console
-from rich.logging import RichHandler
 # import requests
-from dotenv import load_dotenv
+from env_utils import load_env
 from search_utils import perform_search, SEARCH_PROVIDER
 
 # Load environment variables
-load_dotenv()
+load_env()
 
-# Setup rich console for beautiful terminal output
-console = Console()
+log = logging.getLogger("rich")
+TOOL_LOG_LEVEL = os.getenv("TOOL_LOG_LEVEL", "INFO").upper()
+if TOOL_LOG_LEVEL not in logging.getLevelNamesMapping():
+    # A typo in .env shouldn't stop the app from starting
+    log.warning("Unknown TOOL_LOG_LEVEL %r, using INFO", TOOL_LOG_LEVEL)
+    TOOL_LOG_LEVEL = "INFO"
+log.setLevel(TOOL_LOG_LEVEL)
 
-# Configure logging
-logging.basicConfig(
-    level="INFO",
-    format="%(message)s",
-    datefmt="[%X]",
-    handlers=[RichHandler(rich_tracebacks=True)]
-)
 
-log = logging.getLogger("rich")
+def init_logging(console: Console = None):
+    """
+    Configure logging for the app. Called by the entry point rather than at import,
+    so importing the tools doesn't build a Rich handler. Pass the app's console to share it.
+    """
+    if sys.stderr.isatty():
+        # Rich formatting only helps when someone is watching the terminal
+        from rich.logging import RichHandler
+        handler = RichHandler(console=console, rich_tracebacks=True)
+    else:
+        handler = logging.StreamHandler()
+    logging.basicConfig(level="INFO", format="%(message)s", datefmt="[%X]", handlers=[handler])
+
+
+@lru_cache(maxsize=1024)
+def _resolve(cwd: str, path: str) -> str:
+    return os.path.normpath(os.path.join(cwd, path))
+
+def _abs(path: str) -> str:
+    # Same result as os.path.abspath, but repeated paths skip the join and normalization.
+    # Keyed on the working directory so cached results stay right if it ever changes.
+    return _resolve(os.getcwd(), path)
+
+
+MMAP_READ_BYTES = 64 * 1024  # Files larger than this are decoded straight from a memory map
+
+def _write_all(path: str, data: bytes):
+    # Raw open/write/close: no buffered or text layer, and empty content is just the create
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+async def _write_file(path: str, content: str):
+    # Encode once, then open, write and close in a single worker thread hop
+    await asyncio.to_thread(_write_all, path, content.encode("utf-8"))
+
+def _read_mapped(path: str) -> str:
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # Decode from the mapped pages without first copying the file into a bytes object,
+        # translating newlines the way a text-mode read would
+        return str(mm, 'utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+def _list_dir(path: str) -> List[str]:
+    with os.scandir(path) as entries:
+        return [entry.name for entry in entries]
 
 
 class AITools:
     @staticmethod
     async def create_folder(path: str) -> Dict[str, Any]:
-        full_path = os.path.abspath(path)
+        full_path = _abs(path)
         try:
-            os.makedirs(full_path, exist_ok=True)
-            log.info(f"Created folder: {full_path}")
+            await asyncio.to_thread(os.makedirs, full_path, exist_ok=True)
+            log.info("Created folder: %s", full_path)
             return {"success": True, "message": f"Folder created at {full_path}"}
-        except Exception as e:
-            log.error(f"Error creating folder: {str(e)}")
+        except OSError as e:
+            log.error("Error creating folder: %s", e)
             return {"success": False, "error": str(e)}
 
     @staticmethod
     async def create_file(path: str, content: str = "") -> Dict[str, Any]:
-        full_path = os.path.abspath(path)
+        full_path = _abs(path)
         try:
-            with open(full_path, 'w') as f:
-                f.write(content)
-            log.info(f"Created file: {full_path}")
+            await _write_file(full_path, content)
+            log.info("Created file: %s", full_path)
             return {"success": True, "message": f"File created at {full_path}"}
-        except Exception as e:
-            log.error(f"Error creating file: {str(e)}")
+        except (OSError, ValueError) as e:
+            log.error("Error creating file: %s", e)
             return {"success": False, "error": str(e)}
         
     @staticmethod
     async def write_to_file(path: str, content: str) -> Dict[str, Any]:
-        full_path = os.path.abspath(path)
+        full_path = _abs(path)
         try:
-            with open(full_path, 'w') as f:
-                f.write(content)
-            log.info(f"Wrote to file: {full_path}")
+            await _write_file(full_path, content)
+            log.info("Wrote to file: %s", full_path)
             return {"success": True, "message": f"Content written to {full_path}"}
-        except Exception as e:
-            log.error(f"Error writing to file: {str(e)}")
+        except (OSError, ValueError) as e:
+            log.error("Error writing to file: %s", e)
             return {"success": False, "error": str(e)}
 
     @staticmethod
     async def read_file(path: str) -> Dict[str, Any]:
-        full_path = os.path.abspath(path)
+        full_path = _abs(path)
         try:
-            with open(full_path, 'r') as f:
-                content = f.read()
-            log.info(f"Read file: {full_path}")
+            st = await aiofiles.os.stat(full_path)
+            if stat.S_ISDIR(st.st_mode):
+                log.error("Error reading file: %s is a directory", full_path)
+                return {"success": False, "error": f"{full_path} is a directory"}
+            if st.st_size > MMAP_READ_BYTES:
+                content = await asyncio.to_thread(_read_mapped, full_path)
+            else:
+                async with aiofiles.open(full_path, 'r', encoding='utf-8') as f:
+                    content = await f.read()
+            log.info("Read file: %s", full_path)
             return {"success": True, "content": content}
-        except Exception as e:
-            log.error(f"Error reading file: {str(e)}")
+        except (OSError, ValueError) as e:
+            log.error("Error reading file: %s", e)
             return {"success": False, "error": str(e)}
 
     @staticmethod
     async def list_files(path: str = ".") -> Dict[str, Any]:
-        full_path = os.path.abspath(path)
+        full_path = _abs(path)
         try:
-            files = os.listdir(full_path)
-            log.info(f"Listed files in: {full_path}")
+            files = await asyncio.to_thread(_list_dir, full_path)
+            log.info("Listed files in: %s", full_path)
             return {"success": True, "files": files}
-        except Exception as e:
-            log.error(f"Error listing files: {str(e)}")
+        except OSError as e:
+            log.error("Error listing files: %s", e)
             return {"success": False, "error": str(e)}
 
     @staticmethod
     async def delete_file(path: str) -> Dict[str, Any]:
-        full_path = os.path.abspath(path)
+        full_path = _abs(path)
         try:
-            os.remove(full_path)
-            log.info(f"Deleted file: {full_path}")
+            await asyncio.to_thread(os.remove, full_path)
+            log.info("Deleted file: %s", full_path)
             return {"success": True, "message": f"File deleted: {full_path}"}
-        except Exception as e:
-            log.error(f"Error deleting file: {str(e)}")
+        except OSError as e:
+            log.error("Error deleting file: %s", e)
             return {"success": False, "error": str(e)}
 
     @staticmethod
@@ -186,20 +245,55 @@ AVAILABLE_TOOLS = [
     }
 ]
 
-def get_tool_by_name(name: str) -> Dict[str, Any]:
-    for tool in AVAILABLE_TOOLS:
-        if tool['name'] == name:
-            return tool
-    return None
+# Tool definitions in function-calling format; AVAILABLE_TOOLS is static so these are built once at import
+TOOLS_PAYLOAD = [
+    {
+        "type": "function",
+        "function": {
+            "name": tool["name"],
+            "description": tool["description"],
+            "parameters": {
+                "type": "object",
+                "properties": copy.deepcopy(tool["input_schema"]["properties"]),
+                "required": list(tool["input_schema"].get("required", []))
+            }
+        }
+    } for tool in AVAILABLE_TOOLS
+]
+
+# Built once, so the stdlib's default formatting is kept and the prompt text stays as it has always been
+TOOLS_JSON_STRING = "<tools>\n" + "\n".join(json.dumps(tool["function"]) for tool in TOOLS_PAYLOAD) + "\n</tools>"
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+# Read-only all the way down from here on, so the definitions can't drift from the tools block
+# already in the prompt. Frozen mappings aren't JSON serializable: callers that need JSON should
+# use TOOLS_JSON_STRING, or serialize TOOLS_PAYLOAD, which is a separate plain copy.
+AVAILABLE_TOOLS = _freeze(AVAILABLE_TOOLS)
+
+# Tool definitions and implementations by name, built once so lookups are a single dict hit.
+# Only declared tools can be dispatched.
+_TOOL_INDEX = {tool["name"]: tool for tool in AVAILABLE_TOOLS}
+_TOOL_DISPATCH = {name: getattr(AITools, name) for name in _TOOL_INDEX}
+
+# Names of all declared tools, for callers that only need to validate a name
+TOOL_NAMES = frozenset(_TOOL_INDEX)
+
+def get_tool_by_name(name: str) -> Mapping[str, Any]:
+    return _TOOL_INDEX.get(name)
 
 async def execute_tool(tool_name: str, **kwargs) -> Dict[str, Any]:
-    tool = getattr(AITools, tool_name, None)
-    if tool is None:
+    if tool_name not in TOOL_NAMES:
         return {"success": False, "error": f"Tool '{tool_name}' not found"}
     
     try:
-        result = await tool(**kwargs)
+        result = await _TOOL_DISPATCH[tool_name](**kwargs)
         return result
     except Exception as e:
-        log.error(f"Error executing tool '{tool_name}': {str(e)}")
+        log.error("Error executing tool '%s': %s", tool_name, e)
         return {"success": False, "error": str(e)}
\ No newline at end of file